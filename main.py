@@ -1,11 +1,21 @@
 import os
+import re
+import hmac
+import hashlib
+import time
 import logging
-import requests
 import asyncio
+import difflib
+from typing import NamedTuple
+from urllib.parse import quote_plus
+import aiohttp
+import orjson
+import redis.asyncio as aioredis
 from aiohttp import web
 from telegram import Update, InlineQueryResultArticle, InputTextMessageContent
 from telegram.ext import Application, CommandHandler, MessageHandler, InlineQueryHandler, ContextTypes, filters
 from dotenv import load_dotenv
+from cachetools import TTLCache
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -14,6 +24,10 @@ load_dotenv()
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 WEATHER_API_KEY = os.getenv('WEATHER_API_KEY')
 WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+REDIS_URL = os.getenv('REDIS_URL')
+# Секрет вебхука; по умолчанию выводится из токена бота, чтобы у всех воркеров он совпадал
+WEBHOOK_SECRET = (os.getenv('WEBHOOK_SECRET')
+                  or hashlib.sha256(f"webhook:{TELEGRAM_BOT_TOKEN}".encode()).hexdigest())
 PORT = int(os.getenv('PORT', 10000))
 
 # Настройка логирования
@@ -25,89 +39,304 @@ logger = logging.getLogger(__name__)
 
 # ==================== МОДУЛЬ ПОГОДЫ ====================
 
-def get_weather(city):
+class WeatherInfo(NamedTuple):
+    city: str
+    temp: float
+    description: str
+    rain: float
+    snow: float
+    clouds: int
+    visibility: int
+    wind_speed: float
+
+# OWM обновляет данные не чаще раза в ~10 минут
+_WEATHER_CACHE = TTLCache(maxsize=1024, ttl=600)
+# Короткий кэш для "город не найден", чтобы не долбить API опечатками
+_NEG_CACHE = TTLCache(maxsize=1024, ttl=60)
+
+NOT_FOUND_ERROR = "Город не найден. Попробуйте написать название на английском."
+UNEXPECTED_ERROR = "Произошла неожиданная ошибка."
+
+# Текущие запросы к OWM: одновременные запросы одного города ждут один ответ
+_INFLIGHT: dict[str, asyncio.Future] = {}
+
+# Недавние успешные запросы каждого пользователя: если OWM не знает город,
+# опечатку ("Mosow") сопоставляем с ними вместо ответа "город не найден"
+class RecentCities:
+    """Нечеткое сопоставление запроса с недавними городами пользователя"""
+
+    def __init__(self, cutoff=0.9, min_len=5, maxsize=64, ttl=600):
+        self.cutoff = cutoff
+        self.min_len = min_len
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._by_user = TTLCache(maxsize=4096, ttl=ttl)
+
+    def match(self, user_id, key):
+        recent = self._by_user.get(user_id)
+        if not recent or key in recent or len(key) < self.min_len:
+            return key
+        matches = difflib.get_close_matches(key, list(recent), n=1, cutoff=self.cutoff)
+        return matches[0] if matches else key
+
+    def add(self, user_id, key):
+        recent = self._by_user.get(user_id)
+        if recent is None:
+            recent = TTLCache(maxsize=self.maxsize, ttl=self.ttl)
+        recent[key] = True
+        # Перезаписываем, чтобы TTL пользователя отсчитывался от последнего запроса
+        self._by_user[user_id] = recent
+
+_RECENT_CITIES = RecentCities()
+
+# Не больше OWM_CONCURRENCY одновременных запросов к OWM, остальные ждут здесь,
+# а не в пуле соединений (там ожидание съедало бы ClientTimeout)
+OWM_CONCURRENCY = 20
+_OWM_SEM = asyncio.Semaphore(OWM_CONCURRENCY)
+# Сколько максимум ждать по Retry-After при ответе 429
+OWM_MAX_RETRY_AFTER = 5
+
+# Общий кэш в Redis (для нескольких воркеров); WeatherInfo хранится списком полей,
+# "null" означает "город не найден"
+REDIS_TTL = 600
+REDIS_NEG_TTL = 60
+
+# После ошибки Redis не трогаем его REDIS_BACKOFF секунд, чтобы каждый промах
+# не ждал таймаута
+REDIS_BACKOFF = 30
+_redis_down_until = 0.0
+# Фоновые записи в Redis (ссылки держим, чтобы задачи не собрал GC)
+_REDIS_WRITES: set[asyncio.Task] = set()
+
+def redis_failed(e):
+    global _redis_down_until
+    logger.warning("Redis unavailable, skipping it for %ss: %s", REDIS_BACKOFF, e)
+    _redis_down_until = time.monotonic() + REDIS_BACKOFF
+
+async def redis_get(redis, key):
+    """Чтение из Redis; при недоступности Redis считаем, что кэша нет"""
+    if time.monotonic() < _redis_down_until:
+        return None
+    try:
+        return await redis.get(f"owm:{key}")
+    except aioredis.RedisError as e:
+        redis_failed(e)
+        return None
+
+async def redis_set(redis, key, value, ttl):
+    if time.monotonic() < _redis_down_until:
+        return
+    try:
+        await redis.set(f"owm:{key}", orjson.dumps(value), ex=ttl)
+    except aioredis.RedisError as e:
+        redis_failed(e)
+
+def redis_set_later(redis, key, value, ttl):
+    """Запись в Redis в фоне, не задерживая ответ пользователю"""
+    task = asyncio.create_task(redis_set(redis, key, value, ttl))
+    _REDIS_WRITES.add(task)
+    task.add_done_callback(_REDIS_WRITES.discard)
+
+def decode_redis_entry(raw):
+    """WeatherInfo из записи Redis; None, если город не найден"""
+    fields = orjson.loads(raw)
+    if fields is None:
+        return None
+    if not isinstance(fields, list):
+        raise TypeError(f"unexpected entry type {type(fields).__name__}")
+    return WeatherInfo(*fields)
+
+async def get_weather(city, session, redis=None, user_id=None):
     """Получение данных о погоде с поддержкой повторных попыток"""
-    
-    def fetch_data(query):
-        url = "https://api.openweathermap.org/data/2.5/weather"
-        params = {
-            'q': query,
-            'appid': WEATHER_API_KEY,
-            'units': 'metric',
-            'lang': 'ru'
-        }
-        return requests.get(url, params=params, timeout=10)
+    key = city.strip().casefold()
+    weather_info, error = await lookup_weather(city, key, session, redis)
+
+    # Только если город не найден, пробуем похожий из недавних запросов:
+    # иначе реальный "Пушкино" подменился бы на "Пушкин"
+    if error == NOT_FOUND_ERROR and user_id is not None:
+        match = _RECENT_CITIES.match(user_id, key)
+        if match != key:
+            key = match
+            weather_info, error = await lookup_weather(match, match, session, redis)
+
+    if weather_info is not None and user_id is not None:
+        _RECENT_CITIES.add(user_id, key)
+    return weather_info, error
+
+async def lookup_weather(city, key, session, redis=None):
+    """Поиск в кэшах, затем один общий запрос к OWM на город"""
+    weather_info = _WEATHER_CACHE.get(key)
+    if weather_info is not None:
+        return weather_info, None
+    if key in _NEG_CACHE:
+        return None, NOT_FOUND_ERROR
+
+    if redis is not None:
+        raw = await redis_get(redis, key)
+        if raw is not None:
+            try:
+                weather_info = decode_redis_entry(raw)
+            except (orjson.JSONDecodeError, TypeError) as e:
+                # Битая или старая запись (например, словарь) — считаем промахом
+                logger.warning("Bad Redis entry for %s: %s", key, e)
+            else:
+                # В локальный кэш не копируем: запись уже прожила часть TTL в Redis,
+                # и локальный TTL сложился бы с ним
+                if weather_info is None:
+                    return None, NOT_FOUND_ERROR
+                return weather_info, None
+
+    fut = _INFLIGHT.get(key)
+    if fut is not None:
+        return await asyncio.shield(fut)
+
+    fut = asyncio.get_running_loop().create_future()
+    _INFLIGHT[key] = fut
+    try:
+        result = await fetch_weather(city, key, session, redis)
+        fut.set_result(result)
+        return result
+    finally:
+        _INFLIGHT.pop(key, None)
+        if not fut.done():
+            fut.set_result((None, UNEXPECTED_ERROR))
+
+OWM_URL = "https://api.openweathermap.org/data/2.5/weather"
+# Неизменная часть строки запроса; к ней добавляется только q=<город>
+_STATIC_QS = f"appid={quote_plus(WEATHER_API_KEY or '')}&units=metric&lang=ru"
+
+async def fetch_weather(city, key, session, redis=None):
+    """Запрос погоды у OWM и сохранение результата в кэши"""
+
+    async def fetch_data(query):
+        url = f"{OWM_URL}?q={quote_plus(query)}&{_STATIC_QS}"
+        for attempt in range(2):
+            async with _OWM_SEM:
+                async with session.get(url) as response:
+                    if response.status == 200:
+                        return response.status, orjson.loads(await response.read())
+                    retry_after = response.headers.get('Retry-After', '1')
+            # 3. При 429 один раз повторяем запрос после паузы (вне семафора)
+            if response.status != 429 or attempt:
+                return response.status, None
+            delay = int(retry_after) if retry_after.isdigit() else 1
+            await asyncio.sleep(min(delay, OWM_MAX_RETRY_AFTER))
 
     try:
         # 1. Попытка поиска "как есть"
-        response = fetch_data(city)
+        status, data = await fetch_data(city)
 
         # 2. Если 404 и есть дефис, пробуем заменить на пробел (Тель-Авив -> Тель Авив)
-        if response.status_code == 404 and '-' in city:
+        if status == 404 and '-' in city:
             city_variant = city.replace('-', ' ')
-            response = fetch_data(city_variant)
+            status, data = await fetch_data(city_variant)
 
-        response.raise_for_status()
-        data = response.json()
+        if status == 404:
+            _NEG_CACHE[key] = True
+            if redis is not None:
+                redis_set_later(redis, key, None, REDIS_NEG_TTL)
+            return None, NOT_FOUND_ERROR
+        if status != 200:
+            return None, "Ошибка при получении данных о погоде."
         
-        weather_info = {
-            'city': data['name'],
-            'temp': data['main']['temp'],
-            'description': data['weather'][0]['description'],
-            'rain': data.get('rain', {}).get('1h', 0),
-            'snow': data.get('snow', {}).get('1h', 0),
-            'clouds': data['clouds']['all'],
-            'visibility': data.get('visibility', 10000),
-            'wind_speed': data['wind']['speed']
-        }
+        weather_info = WeatherInfo(
+            city=data['name'],
+            temp=data['main']['temp'],
+            description=data['weather'][0]['description'],
+            rain=data.get('rain', {}).get('1h', 0),
+            snow=data.get('snow', {}).get('1h', 0),
+            clouds=data['clouds']['all'],
+            visibility=data.get('visibility', 10000),
+            wind_speed=data['wind']['speed']
+        )
+        _WEATHER_CACHE[key] = weather_info
+        if redis is not None:
+            redis_set_later(redis, key, tuple(weather_info), REDIS_TTL)
         return weather_info, None
         
-    except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 404:
-            return None, "Город не найден. Попробуйте написать название на английском."
-        return None, "Ошибка при получении данных о погоде."
-    except requests.exceptions.RequestException:
+    except (aiohttp.ClientError, asyncio.TimeoutError):
         return None, "Не удалось связаться с сервисом погоды."
     except Exception as e:
-        logger.error(f"Unexpected error: {e}")
-        return None, "Произошла неожиданная ошибка."
+        logger.error("Unexpected error: %s", e)
+        return None, UNEXPECTED_ERROR
 
 # ==================== МОДУЛЬ СООБЩЕНИЙ ====================
 
-def generate_bolt_message(weather_data):
-    """Генерация сообщения о состоянии болта"""
+def _build_bolt_message(mask):
     messages = []
-    if weather_data['rain'] > 0: messages.append("БОЛТ МОКРЫЙ - ИДЕТ ДОЖДЬ")
+    if mask & 1: messages.append("БОЛТ МОКРЫЙ - ИДЕТ ДОЖДЬ")
     else: messages.append("БОЛТ СУХОЙ - ДОЖДЯ НЕТ")
     
-    if weather_data['clouds'] < 30: messages.append("БОЛТ ОТБРАСЫВАЕТ ТЕНЬ - ЯСНО")
+    if mask & 2: messages.append("БОЛТ ОТБРАСЫВАЕТ ТЕНЬ - ЯСНО")
     else: messages.append("БОЛТ НЕ ОТБРАСЫВАЕТ ТЕНЬ - ОБЛАЧНО")
     
-    if weather_data['visibility'] < 1000: messages.append("БОЛТА НЕ ВИДНО - ТУМАН")
+    if mask & 4: messages.append("БОЛТА НЕ ВИДНО - ТУМАН")
     else: messages.append("БОЛТ ВИДНО - ТУМАНА НЕТ")
     
-    if weather_data['wind_speed'] > 5: messages.append("БОЛТ КАЧАЕТСЯ - ВЕТРЕННО")
+    if mask & 8: messages.append("БОЛТ КАЧАЕТСЯ - ВЕТРЕННО")
     else: messages.append("БОЛТ НЕ КАЧАЕТСЯ - НЕ ВЕТРЕННО")
     
-    if weather_data['snow'] > 0: messages.append("БОЛТ В БЕЛОМ - СНЕГ")
+    if mask & 16: messages.append("БОЛТ В БЕЛОМ - СНЕГ")
     
     return "\n".join(messages)
 
+# Все 32 варианта сообщения: бит на каждое условие (дождь, ясно, туман, ветер, снег)
+_BOLT_MSGS = tuple(_build_bolt_message(mask) for mask in range(32))
+
+def generate_bolt_message(weather_data, _msgs=_BOLT_MSGS):
+    """Генерация сообщения о состоянии болта"""
+    idx = ((weather_data.rain > 0)
+           | (weather_data.clouds < 30) << 1
+           | (weather_data.visibility < 1000) << 2
+           | (weather_data.wind_speed > 5) << 3
+           | (weather_data.snow > 0) << 4)
+    return _msgs[idx]
+
+_DETAIL_TPL = ("🌡 Погода в городе {city}\n"
+               "Температура: {temp:.1f}°C\n"
+               "Описание: {description}\n\n"
+               "⚙️ Состояние метеоболта:\n{bolt}")
+
 def generate_detailed_message(weather_data):
-    bolt_status = generate_bolt_message(weather_data)
-    return (f"🌡 Погода в городе {weather_data['city']}\n"
-            f"Температура: {weather_data['temp']:.1f}°C\n"
-            f"Описание: {weather_data['description']}\n\n"
-            f"⚙️ Состояние метеоболта:\n{bolt_status}")
+    return _DETAIL_TPL.format(city=weather_data.city, temp=weather_data.temp,
+                              description=weather_data.description,
+                              bolt=generate_bolt_message(weather_data))
 
 # ==================== ОБРАБОТЧИКИ БОТА ====================
 
+# Похоже на название города: буквы, пробелы, дефисы, точки, апострофы
+# и запятые (формат OWM "город,страна": "Paris,US")
+_CITY_RE = re.compile(r"^[\w\s\-'.,]{1,60}$", re.UNICODE)
+
+def is_valid_city(city):
+    """Отсекаем мусор до запроса к OWM"""
+    return bool(_CITY_RE.match(city)) and any(c.isalpha() for c in city)
+
+_WELCOME = "🔩 Привет! Я бот-метеоболт! Напиши мне город."
+
+# Карточки ошибок для inline-режима: по одной на каждый текст ошибки
+_ERR_CARD_CACHE: dict[str, list] = {}
+
+def error_card(error):
+    results = _ERR_CARD_CACHE.get(error)
+    if results is None:
+        results = _ERR_CARD_CACHE[error] = [InlineQueryResultArticle(
+            id="error", title=f"❌ {error}", 
+            input_message_content=InputTextMessageContent(message_text=f"❌ {error}")
+        )]
+    return results
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("🔩 Привет! Я бот-метеоболт! Напиши мне город.")
+    await update.message.reply_text(_WELCOME)
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     city = update.message.text.strip()
-    weather_data, error = get_weather(city)
+    if not is_valid_city(city):
+        await update.message.reply_text("❌ Это не похоже на название города.")
+        return
+    weather_data, error = await get_weather(
+        city, context.bot_data['http'], context.bot_data.get('redis'), update.effective_user.id
+    )
     if error:
         await update.message.reply_text(f"❌ {error}")
         return
@@ -115,50 +344,54 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.inline_query.query.strip()
-    if not query: return
-    
-    weather_data, error = get_weather(query)
-    results = []
+    if not query or not is_valid_city(query): return
     
+    weather_data, error = await get_weather(
+        query, context.bot_data['http'], context.bot_data.get('redis'), update.effective_user.id
+    )
     if error:
-        results = [InlineQueryResultArticle(
-            id="error", title=f"❌ {error}", 
-            input_message_content=InputTextMessageContent(message_text=f"❌ {error}")
-        )]
+        results = error_card(error)
     else:
         bolt_message = generate_bolt_message(weather_data)
-        full_message = f"🔩 Метеоболт: {weather_data['city']}\n\n{bolt_message}"
+        full_message = f"🔩 Метеоболт: {weather_data.city}\n\n{bolt_message}"
         results = [InlineQueryResultArticle(
-            id=weather_data['city'],
-            title=f"🔩 {weather_data['city']}",
-            description=f"{weather_data['temp']:.1f}°C, {weather_data['description']}",
+            id=weather_data.city,
+            title=f"🔩 {weather_data.city}",
+            description=f"{weather_data.temp:.1f}°C, {weather_data.description}",
             input_message_content=InputTextMessageContent(message_text=full_message)
         )]
     await update.inline_query.answer(results, cache_time=300)
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.error(f"Update {update} caused error {context.error}")
+    logger.error("Update error: %s", context.error, exc_info=context.error)
 
 # ==================== ВЕБ-СЕРВЕР (AIOHTTP) ====================
 
+_ALIVE_BODY = b"Bot is alive!"
+
 async def health_check_handler(request):
     """Обработчик для UptimeRobot"""
-    return web.Response(text="Bot is alive!", status=200)
+    return web.Response(body=_ALIVE_BODY, content_type="text/plain")
 
 async def telegram_webhook_handler(request):
     """Обработчик входящих вебхуков от Telegram"""
+    # Отсекаем чужие запросы до разбора JSON
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    # Сравниваем байты: str с не-ASCII символами compare_digest не принимает
+    if not hmac.compare_digest(token.encode('utf-8', 'surrogateescape'), WEBHOOK_SECRET.encode()):
+        return web.Response(status=403)
     try:
         # Получаем бота из приложения
         bot_app = request.app['bot_app']
         # Читаем JSON
-        data = await request.json()
+        data = orjson.loads(await request.read())
         # Превращаем JSON в объект Update
         update = Update.de_json(data, bot_app.bot)
         # Отправляем update в очередь бота
         await bot_app.process_update(update)
         return web.Response()
     except Exception as e:
-        logger.error(f"Error in webhook handler: {e}")
+        logger.error("Error in webhook handler: %s", e)
         return web.Response(status=500)
 
 # ==================== ЗАПУСК ====================
@@ -178,31 +411,71 @@ async def main():
     # Инициализация бота
     await application.initialize()
     await application.start()
-    
-    # Установка вебхука (сообщаем Телеграму, куда слать данные)
-    webhook_path = f"{WEBHOOK_URL}/webhook"
-    logger.info(f"Setting webhook to {webhook_path}")
-    await application.bot.set_webhook(url=webhook_path, drop_pending_updates=True)
-
-    # 2. Настройка ВЕБ-СЕРВЕРА
-    app = web.Application()
-    app['bot_app'] = application # Сохраняем ссылку на бота внутри веб-приложения
-    
-    # Регистрируем маршруты
-    app.router.add_get('/health', health_check_handler)   # Для UptimeRobot
-    app.router.add_post('/webhook', telegram_webhook_handler) # Для Telegram
 
-    # Запуск сервера
-    runner = web.AppRunner(app)
-    await runner.setup()
-    site = web.TCPSite(runner, '0.0.0.0', PORT)
-    logger.info(f"Сервер запущен на порту {PORT}")
-    await site.start()
+    # Общая HTTP-сессия для запросов к OpenWeatherMap: keep-alive соединения
+    # и кэш DNS переиспользуются между запросами. Сжатие отдельно настраивать
+    # не нужно: aiohttp сам шлет "Accept-Encoding: gzip, deflate" и распаковывает ответ
+    connector = aiohttp.TCPConnector(limit=100, limit_per_host=OWM_CONCURRENCY, keepalive_timeout=75, ttl_dns_cache=300)
+    session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=10))
+    application.bot_data['http'] = session
+    redis = None
+    runner = None
+
+    try:
+        # Прогрев DNS и TLS, чтобы первый запрос пользователя не ждал рукопожатия
+        try:
+            async with session.head("https://api.openweathermap.org/", allow_redirects=False):
+                pass
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning("OWM prewarm failed: %s", e)
+
+        # Общий кэш Redis (необязательно, только если задан REDIS_URL)
+        # Короткие таймауты и REDIS_BACKOFF: недоступный Redis задерживает не больше одного запроса
+        redis = (aioredis.Redis.from_url(REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+                 if REDIS_URL else None)
+        application.bot_data['redis'] = redis
+        
+        # Установка вебхука (сообщаем Телеграму, куда слать данные)
+        webhook_path = f"{WEBHOOK_URL}/webhook"
+        logger.info("Setting webhook to %s", webhook_path)
+        await application.bot.set_webhook(
+            url=webhook_path, secret_token=WEBHOOK_SECRET, drop_pending_updates=True
+        )
+
+        # 2. Настройка ВЕБ-СЕРВЕРА
+        app = web.Application()
+        app['bot_app'] = application # Сохраняем ссылку на бота внутри веб-приложения
+        
+        # Регистрируем маршруты
+        app.router.add_get('/health', health_check_handler)   # Для UptimeRobot
+        app.router.add_post('/webhook', telegram_webhook_handler) # Для Telegram
+
+        # Запуск сервера
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '0.0.0.0', PORT)
+        logger.info("Сервер запущен на порту %s", PORT)
+        await site.start()
 
-    # Бесконечный цикл ожидания (чтобы программа не закрылась)
-    await asyncio.Event().wait()
+        # Бесконечный цикл ожидания (чтобы программа не закрылась)
+        await asyncio.Event().wait()
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+        await session.close()
+        if redis is not None:
+            await redis.aclose()
+        await application.stop()
+        await application.shutdown()
 
 if __name__ == '__main__':
+    # uvloop быстрее стандартного цикла asyncio (на Windows его нет)
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
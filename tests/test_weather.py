@@ -0,0 +1,274 @@
+import asyncio
+import os
+import sys
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import orjson
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import main
+
+
+def owm_payload(name):
+    return {
+        'name': name,
+        'main': {'temp': 12.3},
+        'weather': [{'description': 'ясно'}],
+        'clouds': {'all': 10},
+        'visibility': 10000,
+        'wind': {'speed': 2.0},
+    }
+
+
+class FakeResponse:
+    def __init__(self, status, body=b''):
+        self.status = status
+        self.headers = {}
+        self._body = body
+
+    async def read(self):
+        return self._body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeSession:
+    """Отвечает как OWM: известные города по q=, остальные 404"""
+
+    def __init__(self, cities):
+        self.cities = cities
+        self.queries = []
+
+    def get(self, url):
+        query = parse_qs(urlsplit(url).query)['q'][0]
+        self.queries.append(query)
+        name = self.cities.get(query.casefold())
+        if name is None:
+            return FakeResponse(404)
+        return FakeResponse(200, orjson.dumps(owm_payload(name)))
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    main._WEATHER_CACHE.clear()
+    main._NEG_CACHE.clear()
+    main._RECENT_CITIES = main.RecentCities()
+    main._redis_down_until = 0.0
+    yield
+
+
+def test_similar_real_city_is_not_replaced():
+    session = FakeSession({'пушкин': 'Пушкин', 'пушкино': 'Пушкино'})
+
+    async def run():
+        first, _ = await main.get_weather('Пушкин', session, user_id=1)
+        second, error = await main.get_weather('Пушкино', session, user_id=1)
+        return first, second, error
+
+    first, second, error = asyncio.run(run())
+    assert first.city == 'Пушкин'
+    assert error is None
+    assert second.city == 'Пушкино'
+
+
+def test_typo_falls_back_to_recent_city_after_404():
+    session = FakeSession({'moscow': 'Москва'})
+
+    async def run():
+        await main.get_weather('Moscow', session, user_id=1)
+        return await main.get_weather('Mosow', session, user_id=1)
+
+    weather_info, error = asyncio.run(run())
+    assert error is None
+    assert weather_info.city == 'Москва'
+    assert session.queries == ['Moscow', 'Mosow']
+
+
+def test_typo_does_not_match_other_users_cities():
+    session = FakeSession({'moscow': 'Москва'})
+
+    async def run():
+        await main.get_weather('Moscow', session, user_id=1)
+        return await main.get_weather('Mosow', session, user_id=2)
+
+    weather_info, error = asyncio.run(run())
+    assert weather_info is None
+    assert error == main.NOT_FOUND_ERROR
+
+
+class FakeRequest:
+    def __init__(self, headers):
+        self.headers = headers
+        self.app = {}
+
+
+@pytest.mark.parametrize('token', ['', 'wrong', 'секрет', 'bad\udcff'])
+def test_webhook_rejects_wrong_secret(token):
+    request = FakeRequest({'X-Telegram-Bot-Api-Secret-Token': token})
+    response = asyncio.run(main.telegram_webhook_handler(request))
+    assert response.status == 403
+
+
+class FakeRedis:
+    def __init__(self, data):
+        self.data = data
+        self.calls = 0
+
+    async def get(self, key):
+        self.calls += 1
+        return self.data.get(key)
+
+    async def set(self, key, value, ex=None):
+        self.data[key] = value
+
+
+@pytest.mark.parametrize('raw', [
+    b'not json',
+    orjson.dumps({field: 0 for field in main.WeatherInfo._fields}),
+    orjson.dumps([1, 2]),
+])
+def test_bad_redis_entry_is_a_cache_miss(raw):
+    session = FakeSession({'paris': 'Париж'})
+    redis = FakeRedis({'owm:paris': raw})
+
+    async def run():
+        result = await main.get_weather('Paris', session, redis)
+        await asyncio.gather(*main._REDIS_WRITES)
+        return result
+
+    weather_info, error = asyncio.run(run())
+    assert error is None
+    assert weather_info.city == 'Париж'
+    assert session.queries == ['Paris']
+    assert main.decode_redis_entry(redis.data['owm:paris']) == weather_info
+
+
+@pytest.mark.parametrize('city', ['Тель-Авив', 'St. Petersburg', "N'Djamena", 'Paris,US', 'London, GB'])
+def test_valid_city(city):
+    assert main.is_valid_city(city)
+
+
+@pytest.mark.parametrize('city', ['123', '!!!', 'a' * 61, 'http://x', '...', '___', '-', '12 34'])
+def test_invalid_city(city):
+    assert not main.is_valid_city(city)
+
+
+def test_recent_cities_ttl_refreshes_on_add():
+    recent = main.RecentCities(ttl=0.2)
+    recent.add(1, 'moscow')
+    time.sleep(0.15)
+    recent.add(1, 'london')
+    time.sleep(0.1)
+    assert recent.match(1, 'londn') == 'london'
+
+
+def test_redis_hit_is_not_recached_locally():
+    session = FakeSession({})
+    paris = main.WeatherInfo('Париж', 12.3, 'ясно', 0, 0, 10, 10000, 2.0)
+    redis = FakeRedis({'owm:paris': orjson.dumps(tuple(paris)), 'owm:atlantis': b'null'})
+
+    async def run():
+        return (await main.get_weather('Paris', session, redis),
+                await main.get_weather('Atlantis', session, redis))
+
+    found, missing = asyncio.run(run())
+    assert found == (paris, None)
+    assert missing == (None, main.NOT_FOUND_ERROR)
+    assert session.queries == []
+    assert 'paris' not in main._WEATHER_CACHE
+    assert 'atlantis' not in main._NEG_CACHE
+
+
+class DownRedis(FakeRedis):
+    async def get(self, key):
+        self.calls += 1
+        raise main.aioredis.ConnectionError('down')
+
+    async def set(self, key, value, ex=None):
+        self.calls += 1
+        raise main.aioredis.ConnectionError('down')
+
+
+def test_redis_is_skipped_after_an_error():
+    session = FakeSession({'paris': 'Париж', 'rome': 'Рим'})
+    redis = DownRedis({})
+
+    async def run():
+        first = await main.get_weather('Paris', session, redis)
+        await asyncio.gather(*main._REDIS_WRITES)
+        second = await main.get_weather('Rome', session, redis)
+        await asyncio.gather(*main._REDIS_WRITES)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first[0].city == 'Париж'
+    assert second[0].city == 'Рим'
+    assert redis.calls == 1
+
+
+class ScriptedSession:
+    """Отдает заранее заданные ответы по очереди"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def get(self, url):
+        self.calls += 1
+        return self.responses.pop(0)
+
+
+def test_429_is_retried_once_after_retry_after():
+    throttled = FakeResponse(429)
+    throttled.headers = {'Retry-After': '0'}
+    session = ScriptedSession([throttled, FakeResponse(200, orjson.dumps(owm_payload('Париж')))])
+
+    weather_info, error = asyncio.run(main.get_weather('Paris', session))
+    assert error is None
+    assert weather_info.city == 'Париж'
+    assert session.calls == 2
+
+
+def test_429_twice_is_an_error():
+    responses = []
+    for _ in range(2):
+        throttled = FakeResponse(429)
+        throttled.headers = {'Retry-After': '0'}
+        responses.append(throttled)
+    session = ScriptedSession(responses)
+
+    weather_info, error = asyncio.run(main.get_weather('Paris', session))
+    assert weather_info is None
+    assert error == "Ошибка при получении данных о погоде."
+    assert session.calls == 2
+
+
+class SlowResponse(FakeResponse):
+    async def __aenter__(self):
+        await asyncio.sleep(0.05)
+        return self
+
+
+class SlowSession(FakeSession):
+    def get(self, url):
+        response = super().get(url)
+        return SlowResponse(response.status, response._body)
+
+
+def test_concurrent_requests_for_one_city_are_coalesced():
+    session = SlowSession({'paris': 'Париж'})
+
+    async def run():
+        return await asyncio.gather(*(main.get_weather('Paris', session) for _ in range(10)))
+
+    results = asyncio.run(run())
+    assert session.queries == ['Paris']
+    assert all(weather_info.city == 'Париж' and error is None for weather_info, error in results)
+    assert main._INFLIGHT == {}